@@ -2,6 +2,12 @@ import bpy
 import os
 import time
 import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+from functools import lru_cache
 from .pypresence import pypresence as rpc
 
 
@@ -19,12 +25,54 @@ bl_info = {
 # Blender Bot ID
 rpcConn = None
 rpcConnThread = None
+# Bumped on unregister so in-flight connection attempts are discarded
+connectGeneration = 0
+connectLock = threading.Lock()
 lastConnectAttempt = 0.0
-reconnectCooldown = 10.0
+reconnectCooldownMin = 10.0
+reconnectCooldownMax = 300.0
+reconnectCooldown = reconnectCooldownMin
+connectAttempts = 3
 # Name of Blender icon that has been uploaded to the discord bot
 iconBlender = 'blender'
-# Get the temp directory of the system based on Blender's temp dir
-pidFilePath = os.path.join(os.path.dirname(os.path.normpath(bpy.app.tempdir)), "BlendRpcPid")
+# Easy-to-read Blender version, constant for the process lifetime
+versionCycle = {
+    "release": "Release",
+    "rc": "Release Candidate",
+    "beta": "Beta",
+    "alpha": "Alpha"
+}.get(bpy.app.version_cycle, "")
+versionStr = f"{bpy.app.version[0]}.{bpy.app.version[1]} {versionCycle}"
+# pid of this Blender process
+processPid = os.getpid()
+# Shared lock file in the system temp dir, resolved in register()
+lockFilePath = None
+lockFileFd = None
+lockOpenFailed = False
+# Whether this process holds the lock and owns the presence
+isOwner = False
+# Last activity sent to Discord, to skip identical updates
+lastPayload = None
+# Arguments for rpcConn.update; only start, state and details change
+updateKwargs = {
+    "pid": processPid,
+    "large_image": iconBlender,
+    "large_text": versionStr,
+}
+# The update timer polls often but only sends when something changed.
+# Handlers that may run off the main thread just set pendingUpdate.
+pendingUpdate = False
+pollInterval = 2.0
+updateInterval = 30.0
+lastUpdateTime = 0.0
+# Frame progress string, rebuilt only when the frame changes
+lastFrameRange = None
+frameState = None
+# Display name of the open .blend file, refreshed on load and save
+unsetFileName = object()
+cachedFileName = unsetFileName
+# (handler list, handler) pairs added in register()
+registeredHandlers = []
 # Start time of the Blender session
 startTime = None
 # Info on a rendering session
@@ -32,12 +80,33 @@ renderContext = None
 # For logging errorss.
 # If users have many addons installed, good to know which one is generating problems!
 logPrefix = "[Blender-rpc]"
+# Mirror of the enableLogging preference, so log() is free when disabled
+logEnabled = False
 
-def log(message):
+def getPrefs():
+    """Addon preferences
+    If the addon is not enabled yet, return None
+    """
     addon_entry = bpy.context.preferences.addons.get(__name__)
-    if addon_entry is not None and addon_entry.preferences.enableLogging:
+    if addon_entry is None:
+        return None
+    return addon_entry.preferences
+
+def log(message):
+    if logEnabled:
         print(f"{logPrefix} {message}")
 
+def updateLogEnabled(self, context):
+    """Keep logEnabled in sync with the enableLogging preference"""
+    global logEnabled
+    logEnabled = self.enableLogging
+
+def syncLogEnabled():
+    """Re-read enableLogging after the preferences were replaced"""
+    global logEnabled
+    prefs = getPrefs()
+    logEnabled = prefs is not None and prefs.enableLogging
+
 
 class RenderInfo:
     def __init__(self):
@@ -48,147 +117,238 @@ class RenderInfo:
     def isAnimation(self):
         return self.renderedFrames > 0
 
-def connectToDiscord(currentTry = 0):
+def connectToDiscord(generation):
+    """Connect to the Discord client, blocking on IPC
+
+    Runs on a background thread, so rpcConn is only assigned
+      once the connection is established, and only if the addon
+      has not been unregistered since the attempt started.
+    """
     global rpcConn
+    global lastPayload
+    global reconnectCooldown
+    global pendingUpdate
 
-    try:
-        rpcConn = rpc.Presence("674448359850901546")
-        rpcConn.connect()
-        log("Connected to Discord!")
-        return
-    except rpc.ConnectionTimeout:
-        if currentTry >= 3:
-            log("Connection aborted")
+    for attempt in range(connectAttempts):
+        try:
+            conn = rpc.Presence("674448359850901546")
+            conn.connect()
+            with connectLock:
+                if generation != connectGeneration:
+                    conn.close()
+                    return
+                lastPayload = None
+                reconnectCooldown = reconnectCooldownMin
+                rpcConn = conn
+                pendingUpdate = True
+            log("Connected to Discord!")
             return
-        log(f"Connection failed ({currentTry+1}/3)")
-        connectToDiscord(currentTry=currentTry+1)
-    except rpc.InvalidID:
-        log("Discord bot ID invalid. Please report to developer on Github")
-        log("https://github.com/Protinon/Blender-rpc/issues")
-    except rpc.DiscordNotFound:
-        log("Discord was not found. Aborting.")
-    except rpc.InvalidPipe:
-        log("Invalid IPC pipe. Aborting.")
-    except rpc.DiscordError as ex:
-        log(f"Unknown Discord error: {ex}. Aborting.")
-    except Exception as ex:
-        log(f"Unknown error: {ex}. Aborting.")
-    
-    rpcConn = None
+        except rpc.ConnectionTimeout:
+            log(f"Connection failed ({attempt+1}/{connectAttempts})")
+            continue
+        except rpc.InvalidID:
+            log("Discord bot ID invalid. Please report to developer on Github")
+            log("https://github.com/Protinon/Blender-rpc/issues")
+        except rpc.DiscordNotFound:
+            log("Discord was not found. Aborting.")
+        except rpc.InvalidPipe:
+            log("Invalid IPC pipe. Aborting.")
+        except rpc.DiscordError as ex:
+            log(f"Unknown Discord error: {ex}. Aborting.")
+        except Exception as ex:
+            log(f"Unknown error: {ex}. Aborting.")
+        break
+    else:
+        log("Connection aborted")
 
 def register():
     global startTime
-    global rpcConnThread
+    global lastConnectAttempt
+    global reconnectCooldown
+    global lastUpdateTime
+    global lockFilePath
+    global cachedFileName
 
+    # Registered first: Blender does not call unregister() if this fails
     bpy.utils.register_class(RpcTestOperator)
     bpy.utils.register_class(RpcPreferences)
+    syncLogEnabled()
+    cachedFileName = unsetFileName
     startTime = time.time()
-    rpcConnThread = threading.Thread(target=connectToDiscord, daemon=True)
-    rpcConnThread.start()
-    writePidFileAtomic()
+    lastConnectAttempt = 0.0
+    reconnectCooldown = reconnectCooldownMin
+    lastUpdateTime = 0.0
+    # Get the temp directory of the system based on Blender's temp dir
+    lockFilePath = os.path.join(os.path.dirname(os.path.normpath(bpy.app.tempdir)), "BlendRpcLock")
+    acquireOwnership()
+    bpy.app.timers.register(connectTimer, first_interval=0.1)
     bpy.app.timers.register(updatePresenceTimer, first_interval=1.0, persistent=True)
-    bpy.app.handlers.save_post.append(writePidHandler)
-    # Rendering
-    bpy.app.handlers.render_init.append(startRenderJobHandler)
-    bpy.app.handlers.render_complete.append(endRenderJobHandler)
-    bpy.app.handlers.render_cancel.append(endRenderJobHandler)
-    bpy.app.handlers.render_post.append(postRenderHandler)
-    bpy.app.handlers.load_post.append(fileLoadHandler)
-
-def unregister():
-    global startTime
-
-    startTime = None
-    if rpcConn is not None:
-        rpcConn.close()
-    removePidFile()
-    if bpy.app.timers.is_registered(updatePresenceTimer):
-        bpy.app.timers.unregister(updatePresenceTimer)
-    try:
-        bpy.app.handlers.save_post.remove(writePidHandler)
-    except ValueError:
-        pass
-    bpy.utils.unregister_class(RpcTestOperator)
-    bpy.utils.unregister_class(RpcPreferences)
-    # Rendering
     for handler_list, handler in (
+        (bpy.app.handlers.save_post, savePostHandler),
+        # Rendering
         (bpy.app.handlers.render_init, startRenderJobHandler),
         (bpy.app.handlers.render_complete, endRenderJobHandler),
         (bpy.app.handlers.render_cancel, endRenderJobHandler),
         (bpy.app.handlers.render_post, postRenderHandler),
         (bpy.app.handlers.load_post, fileLoadHandler),
     ):
+        handler_list.append(handler)
+        registeredHandlers.append((handler_list, handler))
+
+def unregister():
+    global startTime
+    global rpcConn
+    global connectGeneration
+    global pendingUpdate
+
+    startTime = None
+    with connectLock:
+        connectGeneration += 1
+        if rpcConn is not None:
+            rpcConn.close()
+            rpcConn = None
+    releaseOwnership()
+    if bpy.app.timers.is_registered(connectTimer):
+        bpy.app.timers.unregister(connectTimer)
+    if bpy.app.timers.is_registered(updatePresenceTimer):
+        bpy.app.timers.unregister(updatePresenceTimer)
+    pendingUpdate = False
+    for handler_list, handler in registeredHandlers:
         try:
             handler_list.remove(handler)
         except ValueError:
             pass
+    registeredHandlers.clear()
+    bpy.utils.unregister_class(RpcTestOperator)
+    bpy.utils.unregister_class(RpcPreferences)
 
-def writePidFileAtomic():
-    """Write the process pid to a file
-    os.replace is a cross-platform atomic operation
-    """
-    pid = os.getpid()
-    tmpPidFilePath = f"{pidFilePath}-{pid}"
-    with open(tmpPidFilePath, "w") as tmpPidFile:
-        tmpPidFile.write(str(pid))
-        tmpPidFile.flush()
-        os.fsync(tmpPidFile.fileno())
-    os.replace(tmpPidFilePath, pidFilePath)
-
-def readPidFile():
-    """Read a pid from the designated file
-
-    Since this is not important data, it's ok to silently
-      fail if the data cannot be read. 
+def lockFile(fd):
+    """Take a non-blocking exclusive lock, raising OSError if it is held"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+def acquireOwnership():
+    """Try to become the instance that shows its presence
+
+    Blender instances compete for a lock on a shared file. The OS
+      releases it when the owner exits, so a stale file after a
+      crash is harmless.
     """
+    global lockFileFd
+    global lockOpenFailed
+    global isOwner
+    if isOwner:
+        return True
+    if lockFileFd is None:
+        try:
+            lockFileFd = os.open(lockFilePath, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as ex:
+            if not lockOpenFailed:
+                log(f"Could not open lock file: {ex}.")
+                lockOpenFailed = True
+            return False
     try:
-        with open(pidFilePath, 'r') as pidFile:
-            storedPid = int(pidFile.read())
+        lockFile(lockFileFd)
     except OSError:
-        return None
-    except ValueError:
-        return None
-    return storedPid
+        # Held by another Blender instance
+        return False
+    isOwner = True
+    return True
+
+def releaseOwnership():
+    """Release the lock so another Blender instance can take over
 
-def removePidFile():
+    The file itself is left in place: deleting it while others
+      hold it open would let two instances lock different files.
+    """
+    global lockFileFd
+    global lockOpenFailed
+    global isOwner
+    lockOpenFailed = False
+    if lockFileFd is None:
+        return
     try:
-        os.remove(pidFilePath)
+        if isOwner and fcntl is None:
+            os.lseek(lockFileFd, 0, os.SEEK_SET)
+            msvcrt.locking(lockFileFd, msvcrt.LK_UNLCK, 1)
+        os.close(lockFileFd)
     except OSError:
         pass
+    lockFileFd = None
+    isOwner = False
 
 @bpy.app.handlers.persistent
-def writePidHandler(*args):
-    writePidFileAtomic()
+def savePostHandler(*args):
+    global cachedFileName
+    cachedFileName = unsetFileName
+    acquireOwnership()
 
 @bpy.app.handlers.persistent
 def startRenderJobHandler(*args):
     """Run when Blender enters Rendering mode"""
     global renderContext
+    global lastPayload
     renderContext = RenderInfo()
+    lastPayload = None
 
 @bpy.app.handlers.persistent
 def endRenderJobHandler(*args):
     """Run when Blender exits Rendering mode"""
     global renderContext
+    global lastPayload
+    global pendingUpdate
     renderContext = None
+    lastPayload = None
+    pendingUpdate = True
 
 @bpy.app.handlers.persistent
 def postRenderHandler(*args):
-    """Run when Blender finishes rendering a frame"""
-    global renderContext
-    if renderContext is None:
+    """Run when Blender finishes rendering a frame
+
+    This may run on the render thread, so only flag the change;
+      updatePresenceTimer picks it up on the main thread.
+    """
+    global pendingUpdate
+    ctx = renderContext
+    if ctx is None:
         return
-    renderContext.renderedFrames += 1
+    ctx.renderedFrames += 1
+    pendingUpdate = True
 
 @bpy.app.handlers.persistent
 def fileLoadHandler(*args):
     """Run when Blender loads a .blend file"""
     global startTime
+    global lastPayload
+    global cachedFileName
     startTime = time.time()
+    lastPayload = None
+    cachedFileName = unsetFileName
     
+def connectTimer():
+    """First connection attempt, deferred out of register()"""
+    maybeReconnect()
+    return None
+
 def updatePresenceTimer():
-    updatePresence()
-    return 30.0
+    """Poll every few seconds, updating Discord when needed
+
+    Update while rendering, when a handler flagged a change,
+      or every 30s otherwise. Identical payloads are not re-sent.
+    """
+    global pendingUpdate
+    global lastUpdateTime
+    # Reverting preferences does not fire the enableLogging update
+    syncLogEnabled()
+    now = time.time()
+    if renderContext is not None or pendingUpdate or now - lastUpdateTime >= updateInterval:
+        pendingUpdate = False
+        lastUpdateTime = now
+        updatePresence()
+    return pollInterval
 
 def updatePresence():
     """Send data to Discord
@@ -197,9 +357,11 @@ def updatePresence():
       gathering data for this function.
 
     Since this needs to compete with other Blender instances,
-      check the current pid in the file, and write if there is 
-      nothing there. If other instances delete this file,
-      just write this process's pid and continue.
+      only the instance holding the shared lock file updates
+      Discord. The others retry the lock on each tick and take
+      over once the owner exits.
+
+    Identical consecutive payloads are not re-sent.
 
     ------------------------------
     |   ________                 |
@@ -210,35 +372,44 @@ def updatePresence():
     |                            |
     ------------------------------
     """
+    global lastPayload
+    global lastFrameRange
+    global frameState
+
     # Pre-Checks
     if rpcConn is None:
         maybeReconnect()
         if rpcConn is None:
             return
-    readPid = readPidFile()
-    if readPid is None:
-        writePidFileAtomic()
-    elif readPid != os.getpid():
-        rpcConn.clear()
+    if not acquireOwnership():
+        if lastPayload is not None:
+            rpcConn.clear()
+            lastPayload = None
         return
     
     # Addon Preferences
-    addon_entry = bpy.context.preferences.addons.get(__name__)
-    if addon_entry is None:
+    prefs = getPrefs()
+    if prefs is None:
         return
-    prefs = addon_entry.preferences
+
+    # Render handlers may reset renderContext from another thread
+    ctx = renderContext
 
     # Details and State
-    if renderContext:
+    if ctx:
         # Rendering Details (prefs)
-        if prefs.renderingDisplay == "DISPLAYFILENAME" and getFileName():
-            activityDescription = f"Rendering {getFileName()}"
+        fileName = getFileName()
+        if prefs.renderingDisplay == "DISPLAYFILENAME" and fileName:
+            activityDescription = f"Rendering {fileName}"
         else:
             activityDescription = f"Rendering in {getRenderEngineStr()}"
         # Rendering State
-        if renderContext.isAnimation:
+        if ctx.isAnimation:
             frameRange = getFrameRange()
-            activityState = f"Frame {frameRange[0]} of {frameRange[1]}"
+            if frameRange != lastFrameRange:
+                lastFrameRange = frameRange
+                frameState = f"Frame {frameRange[0]} of {frameRange[1]}"
+            activityState = frameState
         else:
             activityState = "Single Frame"
     else:
@@ -250,72 +421,77 @@ def updatePresence():
             activityDescription = "Editing an unsaved file"
 
     # Start Time (prefs)
-    if prefs.displayTime and not renderContext:
+    if prefs.displayTime and not ctx:
         fStartTime = startTime
-    elif prefs.displayTimeRendering and renderContext:
-        fStartTime = renderContext.startTime
+    elif prefs.displayTimeRendering and ctx:
+        fStartTime = ctx.startTime
     else:
         fStartTime = None
 
-    # Large Icon
-    largeIcon = iconBlender
-    largeIconText = getVersionStr()
+    payload = (fStartTime, activityState, activityDescription)
+    if payload == lastPayload:
+        return
 
+    updateKwargs["start"] = fStartTime
+    updateKwargs["state"] = activityState
+    updateKwargs["details"] = activityDescription
     try:
-        rpcConn.update(
-            pid=os.getpid(),
-            start=fStartTime,
-            state=activityState,
-            details=activityDescription,
-            large_image=largeIcon,
-            large_text=largeIconText,
-        )
+        rpcConn.update(**updateKwargs)
+        lastPayload = payload
     except rpc.DiscordError as ex:
         log(f"Discord update failed: {ex}.")
+        lastPayload = None
         rpcConn.clear()
     except Exception as ex:
         log(f"Unknown update error: {ex}.")
+        lastPayload = None
         rpcConn.clear()
 
 def maybeReconnect():
+    """Start a background connection attempt
+
+    Each failed attempt doubles the cooldown, up to a maximum.
+    """
     global lastConnectAttempt
+    global reconnectCooldown
+    global rpcConnThread
+    if rpcConnThread is not None and rpcConnThread.is_alive():
+        return
     now = time.time()
     if now - lastConnectAttempt < reconnectCooldown:
         return
+    if lastConnectAttempt:
+        reconnectCooldown = min(reconnectCooldown * 2, reconnectCooldownMax)
     lastConnectAttempt = now
-    connectToDiscord()
+    rpcConnThread = threading.Thread(
+        target=connectToDiscord, args=(connectGeneration,), daemon=True
+    )
+    rpcConnThread.start()
 
 def getFileName():
     """Name of this .blend file
     If this is an unsaved file, return None
     """
-    name = bpy.path.display_name_from_filepath(bpy.data.filepath)
-    if name == "":
-        return None
-    return name
-
-def getVersionStr():
-    """Easy-to-read Blender version"""
-    verTup = bpy.app.version
-    verCycle = {
-        "release": "Release",
-        "rc": "Release Candidate",
-        "beta": "Beta",
-        "alpha": "Alpha"
-    }.get(bpy.app.version_cycle, "")
-    return f"{verTup[0]}.{verTup[1]} {verCycle}"
+    global cachedFileName
+    if cachedFileName is unsetFileName:
+        name = bpy.path.display_name_from_filepath(bpy.data.filepath)
+        cachedFileName = name if name != "" else None
+    return cachedFileName
 
 def getRenderEngineStr():
     """Selected render engine"""
-    internalName = bpy.context.engine
+    return formatRenderEngine(bpy.context.engine)
+
+@lru_cache(maxsize=8)
+def formatRenderEngine(internalName):
+    """Readable name for a render engine identifier"""
     internalNameStripped = internalName.replace("BLENDER_", "").replace("_", " ")
     return internalNameStripped.title()
 
 def getFrameRange():
     """Current frame and total remaining frames"""
-    start = bpy.context.scene.frame_start
-    end = bpy.context.scene.frame_end
-    cursor = bpy.context.scene.frame_current
+    scene = bpy.context.scene
+    start, end, cursor = scene.frame_start, scene.frame_end, scene.frame_current
     return (cursor - start + 1, end - start + 1)
 
 
@@ -336,6 +512,7 @@ class RpcPreferences(bpy.types.AddonPreferences):
         name="Enable Logging",
         default=False,
         description="Print addon log messages to the system console",
+        update=updateLogEnabled,
     )
 
     renderingDisplay: bpy.props.EnumProperty(
@@ -360,6 +537,8 @@ class RpcTestOperator(bpy.types.Operator):
     bl_description = "Send a one-off rich presence update"
 
     def execute(self, context):
+        global lastPayload
+        lastPayload = None
         updatePresence()
         self.report({"INFO"}, "Blender RPC: Test update sent")
         return {"FINISHED"}